@@ -1,13 +1,73 @@
+import os
 import time
+import random
+import hashlib
+import pickle
+import tempfile
+import gzip
+import threading
+import zipfile
+import orjson
+import xlsxwriter
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
+import numpy as np
 import pandas as pd
 from io import BytesIO
+from urllib.parse import urlsplit
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xlsx_meta import workbook_sheet_names
 
 # -----------------------
 # Конфигурация
 # -----------------------
 SPEEDY_BASE_URL = "https://api.speedyindex.com/v2"
+# Rust-парсер xlsx (python-calamine): в разы быстрее и экономнее по памяти, чем openpyxl
+EXCEL_ENGINE = "calamine"
+# Кеш разобранных листов на диске (ключ — sha256 содержимого файла и имя листа)
+CACHE_DIR = Path(".cache")
+# Ограничения кеша: в памяти — не больше CACHE_MAX_ENTRIES листов на CACHE_TTL сек,
+# на диске — не больше CACHE_MAX_FILES файлов не старше CACHE_MAX_AGE сек (загруженные данные не храним вечно)
+CACHE_MAX_ENTRIES = 16
+CACHE_TTL = 60 * 60
+CACHE_MAX_FILES = 100
+CACHE_MAX_AGE = 24 * 60 * 60
+# Версия формата кеша — меняется вместе со структурой сохраняемых данных
+CACHE_FORMAT = 4
+# Колонки с URL в порядке приоритета (без учета регистра)
+SOURCE_COLUMNS = ['source', 'url', 'link', 'referring page url']
+# Опрос статуса задач: таймаут, начальная пауза и верхняя граница паузы по умолчанию (сек)
+POLL_TIMEOUT = 300
+POLL_MIN_DELAY = 1.0
+POLL_MAX_DELAY = 10
+# Лимит URL в одной задаче SpeedyIndex
+MAX_URLS_PER_TASK = 10000
+# Параллельных запросов к API (умеренно, чтобы не упереться в rate limit)
+API_WORKERS = 8
+# Тело запроса больше этого размера (байт) отправляется сжатым gzip
+GZIP_MIN_BYTES = 64 * 1024
+# HTTP-статусы, которыми API отклоняет сжатое тело до создания задачи — только на них повторяем запрос без gzip
+GZIP_REJECT_STATUSES = (400, 415)
+# Ячейки, которые считаем ссылками: начало http:// или https:// в любом регистре
+URL_PATTERN = r"https?://"
+
+# Одна сессия на SpeedyIndex и Slack: пул keep-alive соединений без повторных TLS-рукопожатий.
+# cache_resource переживает перезапуски скрипта Streamlit — иначе пул создавался бы заново на каждое действие в UI.
+# Retry по умолчанию не повторяет POST — создание задач не дублируется.
+@st.cache_resource(show_spinner=False)
+def get_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    ))
+    return session
+
+SESSION = get_session()
 
 # -----------------------
 # Функции
@@ -18,19 +78,21 @@ def get_headers(api_key):
         "Content-Type": "application/json"
     }
 
-def get_balance(api_key):
+# Скрипт Streamlit перезапускается на каждое действие в UI — баланс не запрашиваем каждый раз
+@st.cache_data(ttl=60, show_spinner=False)
+def get_balance():
     try:
         url = f"{SPEEDY_BASE_URL}/account"
-        resp = requests.get(url, headers=get_headers(api_key), timeout=5)
+        resp = SESSION.get(url, timeout=5)
         if resp.status_code == 200:
-            return resp.json().get("balance", {}).get("checker", 0)
+            return orjson.loads(resp.content).get("balance", {}).get("checker", 0)
     except:
         return None
     return None
 
 def send_slack_notification(token, channel, message):
     try:
-        requests.post(
+        SESSION.post(
             "https://slack.com/api/chat.postMessage",
             headers={"Authorization": f"Bearer {token}"},
             json={"channel": channel, "text": message},
@@ -41,37 +103,245 @@ def send_slack_notification(token, channel, message):
 
 def find_header_row_and_df(excel_file, sheet_name):
     """
-    Быстро читает первые строки, чтобы найти, где начинаются заголовки (ищем 'Source', 'Link' и т.д.)
-    Возвращает подготовленный DataFrame.
+    Читает лист один раз без заголовков и уже в памяти находит, где начинаются заголовки (ищем 'Source', 'Link' и т.д.)
+    Возвращает подготовленный DataFrame и индекс строки заголовков.
     """
-    # Читаем первые 10 строк без заголовков
-    preview = pd.read_excel(excel_file, sheet_name=sheet_name, header=None, nrows=10)
-    
-    header_row_idx = 0
-    found = False
+    # Читаем лист целиком без заголовков; заголовок ищем в первых 10 строках
+    raw = excel_file.parse(sheet_name, header=None)
+    preview = raw.head(10)
     
     # Ищем строку, содержащую ключевые слова
     keywords = ['source', 'url', 'link', 'referring page']
     
-    for idx, row in preview.iterrows():
-        # Преобразуем строку в нижний регистр и ищем совпадения
-        row_str = row.astype(str).str.lower().tolist()
-        if any(k in ' '.join(row_str) for k in keywords):
-            header_row_idx = idx
-            found = True
-            break
+    # Все строки превью разом: нижний регистр и поиск ключевых слов векторно (np.char), без iterrows
+    low = np.char.lower(preview.to_numpy().astype(str))
+    joined = np.array([' '.join(row) for row in low], dtype=str)
+    found = np.zeros(len(joined), dtype=bool)
+    for k in keywords:
+        found |= np.char.find(joined, k) >= 0
             
-    # Если не нашли, пробуем 0-ю строку по умолчанию
-    if not found:
-        header_row_idx = 0
+    # Первая подходящая строка; если не нашли, пробуем 0-ю строку по умолчанию
+    header_row_idx = int(np.argmax(found)) if found.any() else 0
 
-    # Читаем лист полностью уже с правильным заголовком
-    df = pd.read_excel(excel_file, sheet_name=sheet_name, header=header_row_idx)
+    # Строка заголовков -> имена колонок (пустые и повторяющиеся именуем как pandas: 'Unnamed: N', 'Name.1')
+    columns = []
+    seen = {}
+    for i, name in enumerate(raw.iloc[header_row_idx].tolist() if len(raw) else []):
+        name = f"Unnamed: {i}" if pd.isna(name) else str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+
+    # Данные под заголовком; infer_objects возвращает числовые типы колонкам, которые смешивались с текстом заголовка
+    df = raw.iloc[header_row_idx + 1:].reset_index(drop=True).infer_objects()
+    df.columns = columns
     return df, header_row_idx
 
-def looks_like_url(val):
-    if not isinstance(val, str): return False
-    return val.strip().lower().startswith(('http://', 'https://'))
+@st.cache_data(show_spinner=False)
+def read_sheet_names(file_bytes):
+    """
+    Имена листов прямо из xl/workbook.xml — мгновенно, без разбора самих листов.
+    Полный разбор книги откладывается до нажатия кнопки запуска.
+    """
+    names = workbook_sheet_names(file_bytes)
+    if not names:
+        # Нестандартная структура архива — спрашиваем у движка
+        names = pd.ExcelFile(BytesIO(file_bytes), engine=EXCEL_ENGINE).sheet_names
+    return names
+
+def find_target_column(df):
+    """
+    Ищет колонку Source/URL (независимо от регистра) в порядке приоритета SOURCE_COLUMNS.
+    Возвращает имя колонки или None. При нескольких совпадениях берется первая слева.
+    """
+    # Массив вместо dict {lower: name}: колонки, совпадающие без учета регистра, не затирают друг друга
+    low_cols = np.array([str(c).lower() for c in df.columns])
+    for k in SOURCE_COLUMNS:
+        hits = np.where(low_cols == k)[0]
+        if len(hits):
+            return df.columns[hits[0]]
+    return None
+
+def parse_sheet(excel_file, sheet_name):
+    """
+    Разбирает один лист открытой книги.
+    Возвращает (df, header_row_idx, target_col): колонка URL ищется один раз и кешируется вместе с листом.
+    """
+    df, header_row_idx = find_header_row_and_df(excel_file, sheet_name)
+    return df, header_row_idx, find_target_column(df)
+
+def prune_cache_dir():
+    """
+    Чистит дисковый кеш: удаляет файлы старше CACHE_MAX_AGE и все сверх CACHE_MAX_FILES самых свежих.
+    """
+    try:
+        files = sorted(CACHE_DIR.glob("*.pkl"), key=lambda path: path.stat().st_mtime, reverse=True)
+    except OSError:
+        return # Каталога нет или файл исчез во время обхода — почистим в следующий раз
+    now = time.time()
+    for i, path in enumerate(files):
+        try:
+            if i >= CACHE_MAX_FILES or now - path.stat().st_mtime > CACHE_MAX_AGE:
+                path.unlink()
+        except OSError:
+            pass
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+def load_sheet(digest, sheet_name, _open_workbook):
+    """
+    Разобранный лист: (df, header_row_idx, target_col). Ключ кеша — sha256 файла и имя листа,
+    поэтому разбираются и хранятся только выбранные листы.
+    На диске — .cache/<sha256 файла>.<sha256 имени листа>.v<CACHE_FORMAT>.pkl.
+    _open_workbook() (Streamlit не хеширует параметры с _) открывает книгу только при промахе кеша.
+    Ошибка разбора пробрасывается вызывающему и не кешируется.
+    """
+    prune_cache_dir()
+    sheet_key = hashlib.sha256(sheet_name.encode("utf-8")).hexdigest()[:16]
+    cache_path = CACHE_DIR / f"{digest}.{sheet_key}.v{CACHE_FORMAT}.pkl"
+
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass # Битый кеш — просто парсим заново
+
+    sheet = parse_sheet(_open_workbook(), sheet_name)
+
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump(sheet, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass # Нет прав на запись — работаем без дискового кеша
+    return sheet
+
+@st.cache_resource(show_spinner=False)
+def get_gzip_state():
+    """
+    Принимает ли API gzip-тела запросов. Узнаем по первому большому запросу
+    и помним до перезапуска сервера, чтобы не слать заведомо отклоняемые тела.
+    """
+    return {"enabled": True}
+
+def post_create(body, headers=None):
+    """
+    POST /task/google/checker/create. Возвращает ответ requests как есть.
+    """
+    return SESSION.post(
+        f"{SPEEDY_BASE_URL}/task/google/checker/create",
+        headers=headers,
+        data=body,
+        timeout=10
+    )
+
+def create_task(title, urls, use_gzip):
+    """
+    Создает задачу проверки в SpeedyIndex (потокобезопасно: общая SESSION).
+    use_gzip — флаг из get_gzip_state(): его читает и обновляет основной поток, не рабочие потоки.
+    Возвращает (task_id, None, gzip_rejected) или (None, текст ошибки, gzip_rejected) — вывод в UI делает основной поток.
+    gzip_rejected — API отклонил сжатое тело и запрос ушел повторно без сжатия.
+    """
+    gzip_rejected = False
+    try:
+        # orjson сериализует список из 10k URL в разы быстрее stdlib json
+        body = orjson.dumps({"title": title, "urls": urls})
+        resp = None
+        
+        if use_gzip and len(body) > GZIP_MIN_BYTES:
+            resp = post_create(gzip.compress(body, compresslevel=5), {"Content-Encoding": "gzip"})
+            if resp.status_code in GZIP_REJECT_STATUSES:
+                # Сжатое тело отклонено, задача не создана — повтор без gzip не задвоит ее.
+                # На прочие ответы не повторяем: задача могла создаться и оплатиться
+                gzip_rejected = True
+                resp = None
+        
+        if resp is None:
+            resp = post_create(body)
+        try:
+            data = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            return None, f"Ошибка API: ответ не в формате JSON (HTTP {resp.status_code})", gzip_rejected
+        if data.get("code") == 0:
+            return data["task_id"], None, gzip_rejected
+        return None, f"Ошибка API: {data}", gzip_rejected
+    except Exception as e:
+        return None, f"Сбой сети: {e}", gzip_rejected
+
+def fetch_report(task_id):
+    """
+    Забирает отчет готовой задачи — список проиндексированных URL.
+    """
+    resp = SESSION.post(
+        f"{SPEEDY_BASE_URL}/task/google/checker/report",
+        data=orjson.dumps({"task_id": task_id}), timeout=15
+    )
+    # Отчет содержит O(#URL) строк — orjson разбирает такие массивы в разы быстрее stdlib json
+    return orjson.loads(resp.content).get("result", {}).get("indexed_links", [])
+
+def poll_sleep(interval, max_delay):
+    """
+    Пауза перед следующим опросом (плюс небольшой джиттер).
+    Возвращает следующий интервал: в 1.5 раза больше, но не выше max_delay.
+    """
+    time.sleep(interval + random.uniform(0, 0.5))
+    return min(interval * 1.5, max_delay)
+
+def write_parquet_zip(output, sheets):
+    """
+    Zip-архив с отдельным .parquet (zstd) на каждый лист [(sheet_name, df), ...] —
+    колоночный формат пишется в разы быстрее xlsx. Смешанные object-колонки приводятся к строкам,
+    иначе pyarrow не выведет тип колонки.
+    """
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED) as z:
+        for sheet_name, df in sheets:
+            # Явно только object-колонки: select_dtypes(include="object") в pandas 3 предупреждает и захватывает str
+            obj_cols = [c for c, dtype in df.dtypes.items() if dtype == object]
+            buf = BytesIO()
+            df.astype({c: "string" for c in obj_cols}).to_parquet(buf, engine="pyarrow", compression="zstd", index=False)
+            z.writestr(f"{sheet_name}.parquet", buf.getvalue())
+
+def normalize_url(url):
+    """
+    Каноническая форма URL для сравнения с ответом API:
+    схема и хост в нижнем регистре, пустой путь -> '/'. Query сохраняется, fragment отбрасывается.
+    """
+    try:
+        p = urlsplit(url)
+    except ValueError:
+        return url
+    query = f"?{p.query}" if p.query else ""
+    return f"{p.scheme.lower()}://{p.netloc.lower()}{p.path or '/'}{query}"
+
+def write_xlsx(output, sheets):
+    """
+    Пишет листы [(sheet_name, df), ...] напрямую через xlsxwriter: строка за строкой (write_row),
+    минуя поячеечный ExcelFormatter pandas. Пустые значения (NaN/NA) становятся пустыми ячейками.
+    """
+    # constant_memory: каждая строка сбрасывается на диск сразу после записи — память O(одна строка),
+    # поэтому строки пишутся строго по порядку и к прошлым строкам не возвращаемся.
+    # strings_to_urls=False: URL остаются обычным текстом — гиперссылки копятся в памяти до конца листа,
+    # а сверх 65 530 на лист Excel их не принимает
+    wb = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "strings_to_urls": False,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss"
+    })
+    header_fmt = wb.add_format({"bold": True})
+    
+    for sheet_name, df in sheets:
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+        
+        # Одна object-матрица за проход: обычные Python-скаляры, NaN/NA -> None
+        values = df.to_numpy(dtype=object, na_value=None).tolist()
+        for r_idx, row in enumerate(values, start=1):
+            ws.write_row(r_idx, 0, row)
+    
+    wb.close()
 
 # -----------------------
 # UI Streamlit
@@ -79,6 +349,8 @@ def looks_like_url(val):
 st.set_page_config(page_title="SpeedyIndex TURBO", layout="wide")
 st.title("⚡ Проверка индексации (TURBO Mode)")
 
+poll_max_delay = st.sidebar.slider("Макс. пауза между опросами API, сек", 2, 30, POLL_MAX_DELAY)
+
 if "speedyindex" not in st.secrets or "slack" not in st.secrets:
     st.error("Нет секретов [speedyindex] или [slack]!")
     st.stop()
@@ -87,18 +359,26 @@ api_key = st.secrets["speedyindex"]["api_key"]
 slack_token = st.secrets["slack"]["bot_token"]
 slack_channel = st.secrets["slack"]["channel_id"]
 
+# Заголовки SpeedyIndex ставятся на сессию один раз; Slack передает свой Authorization явно
+SESSION.headers.update(get_headers(api_key))
+
 # Баланс
-bal = get_balance(api_key)
+bal = get_balance()
 if bal is not None:
     st.success(f"💰 Баланс: {bal}")
 
-uploaded_file = st.file_uploader("Файл .xlsx (Загрузка будет мгновенной)", type=["xlsx"])
+# Новый файл — результат прошлого запуска больше не показываем
+uploaded_file = st.file_uploader(
+    "Файл .xlsx (Загрузка будет мгновенной)", type=["xlsx"],
+    on_change=lambda: st.session_state.pop("result", None)
+)
 
 if uploaded_file:
-    # 1. Мгновенное чтение структуры через Pandas
+    file_bytes = uploaded_file.getvalue()
+    
+    # 1. Мгновенное чтение структуры (только список листов)
     try:
-        xl_file = pd.ExcelFile(uploaded_file)
-        all_sheets = xl_file.sheet_names
+        all_sheets = read_sheet_names(file_bytes)
     except Exception as e:
         st.error(f"Ошибка чтения файла: {e}")
         st.stop()
@@ -113,175 +393,225 @@ if uploaded_file:
         st.stop()
 
     if st.button("🚀 ЗАПУСК (TURBO)"):
+        st.session_state.pop("result", None)
         
         progress_bar = st.progress(0)
         status_box = st.empty()
         
-        session = requests.Session()
-        session.headers.update(get_headers(api_key))
-        
         # Словарь для хранения результатов: {sheet_name: modified_dataframe}
         processed_sheets = {}
         
+        # Валидные URL каждого листа: {sheet_name: Series (индекс — строки листа)}
+        sheet_urls = {}
+        
         # Активные задачи API
-        active_tasks = {} # task_id -> {sheet_name, urls_list}
-        total_urls_sent = 0
+        active_tasks = {} # task_id -> {urls} (только URL чанка, без DataFrame)
         
         # --- ЭТАП 1: Подготовка данных и отправка в API ---
         status_box.info("Чтение данных и отправка задач...")
         
+        # Разбираем только выбранные листы (из кеша, если этот файл уже обрабатывали).
+        # Книга открывается при первом промахе кеша, и одна на все такие листы: sharedStrings читаются один раз
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        workbook = {}
+        def open_workbook():
+            if "xl" not in workbook:
+                workbook["xl"] = pd.ExcelFile(BytesIO(file_bytes), engine=EXCEL_ENGINE)
+            return workbook["xl"]
+        
         for sheet in selected_sheets:
-            # Умный поиск заголовка и чтение данных
-            df, _ = find_header_row_and_df(xl_file, sheet)
-            
-            # Ищем колонку Source (независимо от регистра)
-            col_map = {c.lower(): c for c in df.columns}
-            target_col = None
-            for k in ['source', 'url', 'link', 'referring page url']:
-                if k in col_map:
-                    target_col = col_map[k]
-                    break
+            # Умный поиск заголовка и колонки Source выполняется при разборе листа
+            try:
+                df, _, target_col = load_sheet(digest, sheet, open_workbook)
+            except Exception as e:
+                st.warning(f"Не удалось прочитать лист '{sheet}': {e}. Пропускаем.")
+                continue
+            processed_sheets[sheet] = df
             
             if not target_col:
                 st.warning(f"На листе '{sheet}' не найдена колонка Source/URL. Пропускаем.")
-                processed_sheets[sheet] = df # Сохраняем как есть
-                continue
+                continue # Лист сохранится как есть
 
-            # Фильтруем валидные URL для отправки
-            # Создаем маску, чтобы потом записать ответы на свои места
-            valid_mask = df[target_col].apply(looks_like_url)
-            urls_to_check = df[target_col][valid_mask].tolist()
-            urls_to_check = [u.strip() for u in urls_to_check]
-            
-            if not urls_to_check:
-                processed_sheets[sheet] = df
-                continue
-                
-            total_urls_sent += len(urls_to_check)
-            
-            # Отправка в API
-            try:
-                resp = session.post(
-                    f"{SPEEDY_BASE_URL}/task/google/checker/create",
-                    json={"title": sheet, "urls": urls_to_check},
-                    timeout=10
-                )
-                data = resp.json()
-                if data.get("code") == 0:
-                    task_id = data["task_id"]
-                    active_tasks[task_id] = {
-                        "sheet": sheet,
-                        "urls": urls_to_check, # Для контроля порядка (хотя API вернет список)
-                        "original_df": df,
-                        "valid_mask": valid_mask
-                    }
+            # Фильтр валидных URL векторно (строковые ядра pandas вместо Python-вызова на каждую ячейку).
+            # Запоминаем строки, чтобы потом записать ответы на свои места
+            stripped = df[target_col].astype(str).str.strip()
+            valid_mask = stripped.str.match(URL_PATTERN, case=False)
+            if valid_mask.any():
+                sheet_urls[sheet] = stripped[valid_mask]
+                # Колонка результата заранее: компактный nullable bool вместо object-колонки, создаваемой через .loc
+                df["Index"] = pd.Series(pd.NA, index=df.index, dtype="boolean")
+        
+        # DataFrame'ы живут только в processed_sheets, в задачах и sheet_urls — лишь валидные URL.
+        # Книга больше не нужна — закрываем ее до долгого ожидания API
+        if "xl" in workbook:
+            workbook["xl"].close()
+
+        # Все листы уходят в API одной пачкой: только уникальные URL (дубликаты не тарифицируются),
+        # не больше MAX_URLS_PER_TASK на задачу
+        # pd.unique — хеш-дедупликация на уровне C с сохранением порядка появления
+        unique_urls = pd.unique(pd.concat(sheet_urls.values(), ignore_index=True)).tolist() if sheet_urls else []
+        total_rows = sum(len(urls) for urls in sheet_urls.values())
+        
+        # Чанки равного размера (ceil(N / лимит) штук), а не 10000 + хвост из нескольких URL
+        n_chunks = -(-len(unique_urls) // MAX_URLS_PER_TASK)
+        chunks = [c.tolist() for c in np.array_split(np.array(unique_urls, dtype=object), n_chunks)] if n_chunks else []
+        
+        # Флаг gzip читаем и обновляем в основном потоке — рабочие потоки Streamlit API не вызывают
+        gzip_state = get_gzip_state()
+        use_gzip = gzip_state["enabled"]
+        
+        # Задачи создаются параллельно на общей сессии
+        with ThreadPoolExecutor(max_workers=API_WORKERS) as ex:
+            futures = {
+                ex.submit(create_task, f"{uploaded_file.name}#{i}" if n_chunks > 1 else uploaded_file.name, chunk, use_gzip): chunk
+                for i, chunk in enumerate(chunks, start=1)
+            }
+            for fut in as_completed(futures):
+                task_id, error, gzip_rejected = fut.result()
+                if gzip_rejected:
+                    # Больше не сжимаем до перезапуска сервера
+                    gzip_state["enabled"] = False
+                if error:
+                    st.error(error)
                 else:
-                    st.error(f"Ошибка API (Лист {sheet}): {data}")
-                    processed_sheets[sheet] = df 
-            except Exception as e:
-                st.error(f"Сбой сети (Лист {sheet}): {e}")
-                processed_sheets[sheet] = df
+                    active_tasks[task_id] = {"urls": futures[fut]}
 
         if not active_tasks:
             st.warning("Нет активных задач.")
             st.stop()
 
-        # --- ЭТАП 2: Параллельное ожидание (Batch Wait) ---
+        # --- ЭТАП 2: Ожидание задач (Batch Wait) ---
         completed_ids = set()
         all_ids = list(active_tasks.keys())
-        start_time = time.time()
-        
-        while len(completed_ids) < len(all_ids):
-            if time.time() - start_time > 300: # 5 минут таймаут
-                st.error("Таймаут ожидания API.")
-                break
+        indexed_set = set() # Проиндексированные URL по всем задачам (в нормализованном виде)
+        # Прогресс по URL, а не по задачам: все листы идут одной пачкой, и счетчик задач почти не двигается
+        checked_counts = {} # task_id -> сколько URL уже проверено
+        total_sent = sum(len(task["urls"]) for task in active_tasks.values())
+        deadline = time.monotonic() + POLL_TIMEOUT
+        interval = POLL_MIN_DELAY
+        # Один пул на весь этап ожидания: потоки не создаются заново на каждом опросе
+        with ThreadPoolExecutor(max_workers=API_WORKERS) as report_pool:
+            while len(completed_ids) < len(all_ids):
+                if time.monotonic() > deadline: # 5 минут таймаут
+                    st.error("Таймаут ожидания API.")
+                    break
             
-            pending = [tid for tid in all_ids if tid not in completed_ids]
+                pending = [tid for tid in all_ids if tid not in completed_ids]
             
-            try:
-                # Проверяем статус пачкой
-                r = session.post(
-                    f"{SPEEDY_BASE_URL}/task/google/checker/status",
-                    json={"task_ids": pending}, timeout=10
-                )
-                tasks_status = r.json().get("result", [])
+                try:
+                    # Проверяем статус пачкой
+                    r = SESSION.post(
+                        f"{SPEEDY_BASE_URL}/task/google/checker/status",
+                        data=orjson.dumps({"task_ids": pending}), timeout=10
+                    )
+                    # orjson разбирает ответ быстрее stdlib json — опрос идет много раз за прогон
+                    tasks_status = orjson.loads(r.content).get("result", [])
                 
-                still_running = 0
-                for t_stat in tasks_status:
-                    tid = t_stat["id"]
+                    still_running = 0
+                    ready_ids = []
+                    for t_stat in tasks_status:
+                        tid = t_stat["id"]
+                        checked_counts[tid] = t_stat.get("processed_count", 0)
                     
-                    if t_stat.get("is_completed"):
-                        if tid not in completed_ids:
-                            # Задача готова — получаем отчет
-                            r_rep = session.post(
-                                f"{SPEEDY_BASE_URL}/task/google/checker/report",
-                                json={"task_id": tid}, timeout=15
-                            )
-                            rep_data = r_rep.json()
-                            indexed_set = set(rep_data.get("result", {}).get("indexed_links", []))
-                            
-                            # --- ОБРАБОТКА РЕЗУЛЬТАТА ---
-                            task_ctx = active_tasks[tid]
-                            df = task_ctx["original_df"]
-                            mask = task_ctx["valid_mask"]
-                            
-                            # Логика простановки TRUE/FALSE
-                            # Мы используем .apply к колонке URL, проверяя наличие в indexed_set
-                            target_col_name = df.columns[df.columns.str.lower().isin(['source', 'url', 'link'])][0]
-                            
-                            # Создаем серию результатов только для валидных строк
-                            results_series = df.loc[mask, target_col_name].apply(
-                                lambda x: (x.strip() in indexed_set) if isinstance(x, str) else False
-                            )
-                            
-                            # Записываем в колонку Index (создаем новую или перезаписываем)
-                            df.loc[mask, "Index"] = results_series
-                            # Для невалидных URL можно оставить пустоту или False
-                            
-                            processed_sheets[task_ctx["sheet"]] = df
-                            completed_ids.add(tid)
-                    else:
-                        still_running += 1
+                        if t_stat.get("is_completed"):
+                            if tid not in completed_ids:
+                                ready_ids.append(tid)
+                        else:
+                            still_running += 1
                 
-                # Обновление UI
-                done = len(completed_ids)
-                total = len(all_ids)
-                progress_bar.progress(done / total)
-                status_box.info(f"Проверка в процессе... Готово: {done}/{total}. В работе: {still_running}")
+                    # Отчеты готовых задач забираем параллельно: задержка max(RTT), а не сумма
+                    for tid, indexed_links in zip(ready_ids, report_pool.map(fetch_report, ready_ids)):
+                        indexed_set.update(map(normalize_url, indexed_links))
+                        completed_ids.add(tid)
+                        checked_counts[tid] = len(active_tasks[tid]["urls"])
                 
-                if still_running > 0:
-                    time.sleep(2.5) # Пауза между опросами
+                    # Обновление UI
+                    done = len(completed_ids)
+                    total = len(all_ids)
+                    checked = sum(checked_counts.values())
+                    progress_bar.progress(min(1.0, checked / total_sent))
+                    status_box.info(f"Проверка в процессе... URL: {checked}/{total_sent}. Задач готово: {done}/{total}. В работе: {still_running}")
+                
+                    # Адаптивный опрос: появились готовые задачи — снова опрашиваем часто, иначе пауза растет
+                    if ready_ids:
+                        interval = POLL_MIN_DELAY
+                    if still_running > 0:
+                        interval = poll_sleep(interval, poll_max_delay)
                     
-            except Exception as e:
-                st.error(f"Ошибка опроса API: {e}")
-                time.sleep(5)
+                except Exception as e:
+                    st.error(f"Ошибка опроса API: {e}")
+                    interval = poll_sleep(interval, poll_max_delay)
+
+        # --- ОБРАБОТКА РЕЗУЛЬТАТА ---
+        # Раскладываем TRUE/FALSE по строкам всех листов (только для завершенных задач).
+        checked_urls = set()
+        for tid in completed_ids:
+            checked_urls.update(active_tasks[tid]["urls"])
+        # Нормализация — один раз на уникальный URL; дальше сравниваем исходные строки
+        indexed_urls = {url for url in checked_urls if normalize_url(url) in indexed_set}
+        
+        # Векторная разметка: isin (хеш-поиск на уровне C) вместо Python-лямбды на каждую строку
+        # Одна позиционная запись numpy-массивов на лист (iloc без выравнивания по меткам)
+        for sheet, urls in sheet_urls.items():
+            df = processed_sheets[sheet]
+            is_checked = urls.isin(checked_urls).to_numpy()
+            rows = df.index.get_indexer(urls.index[is_checked])
+            df.iloc[rows, df.columns.get_loc("Index")] = urls[is_checked].isin(indexed_urls).to_numpy()
 
         # --- ЭТАП 3: Сохранение и отчет ---
         progress_bar.progress(1.0)
         status_box.success("Готово! Формируем файл...")
         
-        # Сохранение через Pandas (очень быстро)
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            # Проходим по всем листам (в том порядке, как они были в исходнике)
-            for sheet_name in all_sheets:
-                if sheet_name in processed_sheets:
-                    # Записываем обработанный DF
-                    processed_sheets[sheet_name].to_excel(writer, sheet_name=sheet_name, index=False)
-                else:
-                    # Если лист не выбирали, можно попробовать сохранить старый (но это сложно без openpyxl)
-                    # В режиме Turbo мы сохраняем только выбранные или пустые
-                    pass
-                    
-        output.seek(0)
+        # Сохранение напрямую через xlsxwriter, построчно, во временный файл (а не вторую копию книги в RAM)
+        # Проходим по листам в том порядке, как они были в исходнике (сохраняем только выбранные)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
+            tmp_path = tmp.name
+        try:
+            result_sheets = [(name, processed_sheets[name]) for name in all_sheets if name in processed_sheets]
+            write_xlsx(tmp_path, result_sheets)
         
-        # Slack
-        msg = f"🚀 *SpeedyIndex Turbo Report*\nTotal URLs checked: {total_urls_sent}\nSheets processed: {len(processed_sheets)}"
-        send_slack_notification(slack_token, slack_channel, msg)
+            # Slack
+            msg = f"🚀 *SpeedyIndex Turbo Report*\nTotal URLs checked: {len(unique_urls)} unique ({total_rows} rows)\nSheets processed: {len(processed_sheets)}"
+            # Fire-and-forget: кнопка скачивания не ждет ответа Slack
+            threading.Thread(
+                target=send_slack_notification,
+                args=(slack_token, slack_channel, msg),
+                daemon=True
+            ).start()
         
+            # Клик по кнопке скачивания перезапускает скрипт, и этот блок уже не выполнится —
+            # поэтому результат хранится в session_state, а кнопки рисуются ниже, вне блока запуска
+            with open(tmp_path, "rb") as result_file:
+                st.session_state["result"] = {
+                    "xlsx": result_file.read(),
+                    "sheets": result_sheets, # Нужны только для Parquet, пока его не собрали
+                    "parquet": None,
+                }
+        finally:
+            # Временный файл удаляем и тогда, когда запись книги упала с ошибкой
+            os.remove(tmp_path)
+
+    # Результат последнего запуска: переживает перезапуски скрипта после кликов по кнопкам
+    result = st.session_state.get("result")
+    if result:
         st.download_button(
             label="📥 Скачать результат (Fast .xlsx)",
-            data=output,
+            data=result["xlsx"],
             file_name="checked_turbo.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
+        
+        # Тот же результат в Parquet — для загрузки обратно в pandas/BI без разбора xlsx.
+        # Собирается только по запросу: большинству нужен лишь xlsx
+        if result["parquet"] is None and st.button("📦 Подготовить Parquet (.zip)"):
+            parquet_output = BytesIO()
+            write_parquet_zip(parquet_output, result["sheets"])
+            result["parquet"] = parquet_output.getvalue()
+            result["sheets"] = None # DataFrame'ы больше не нужны
+        if result["parquet"] is not None:
+            st.download_button(
+                label="📦 Скачать результат (Parquet, .zip)",
+                data=result["parquet"],
+                file_name="checked_turbo_parquet.zip",
+                mime="application/zip"
+            )
@@ -0,0 +1,56 @@
+import unittest
+import zipfile
+from io import BytesIO
+
+from xlsx_meta import workbook_sheet_names
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+
+def build_xlsx(sheet_names, chart_sheets=(), with_rels=True):
+    """Минимальная книга: xl/workbook.xml (+ rels) с объявленными namespace, как у Excel/xlsxwriter."""
+    all_sheets = [(name, "worksheet") for name in sheet_names] + [(name, "chartsheet") for name in chart_sheets]
+    sheets = "".join(
+        f'<sheet name="{name}" sheetId="{i}" r:id="rId{i}"/>'
+        for i, (name, _) in enumerate(all_sheets, start=1)
+    )
+    rels = "".join(
+        f'<Relationship Id="rId{i}" Type="{REL_NS}/{kind}" Target="{kind}s/sheet{i}.xml"/>'
+        for i, (_, kind) in enumerate(all_sheets, start=1)
+    )
+    workbook_xml = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<workbook xmlns="{MAIN_NS}" xmlns:r="{REL_NS}"><sheets>{sheets}</sheets></workbook>'
+    )
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("xl/workbook.xml", workbook_xml)
+        if with_rels:
+            z.writestr("xl/_rels/workbook.xml.rels", f'<Relationships xmlns="{PKG_REL_NS}">{rels}</Relationships>')
+    return buf.getvalue()
+
+
+class WorkbookSheetNamesTest(unittest.TestCase):
+    def test_reads_names_in_order(self):
+        data = build_xlsx(["Backlinks", "Лист 2", "Referring pages"])
+        self.assertEqual(workbook_sheet_names(data), ["Backlinks", "Лист 2", "Referring pages"])
+
+    def test_skips_chartsheets(self):
+        data = build_xlsx(["Data", "More data"], chart_sheets=["ChartSheet"])
+        self.assertEqual(workbook_sheet_names(data), ["Data", "More data"])
+
+    def test_without_rels_keeps_all_sheets(self):
+        data = build_xlsx(["Data"], chart_sheets=["ChartSheet"], with_rels=False)
+        self.assertEqual(workbook_sheet_names(data), ["Data", "ChartSheet"])
+
+    def test_missing_workbook_xml_returns_empty(self):
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, "w") as z:
+            z.writestr("other.xml", "<x/>")
+        self.assertEqual(workbook_sheet_names(buf.getvalue()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
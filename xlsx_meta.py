@@ -0,0 +1,37 @@
+import zipfile
+import xml.etree.ElementTree as ET
+from io import BytesIO
+
+# -----------------------
+# Метаданные xlsx без разбора листов (только stdlib)
+# -----------------------
+def workbook_sheet_names(file_bytes):
+    """
+    Имена рабочих листов прямо из xl/workbook.xml — мгновенно, без разбора самих листов.
+    Chartsheet/dialogsheet отбрасываются по типу связи в xl/_rels/workbook.xml.rels:
+    движок чтения таких листов не знает.
+    Возвращает пустой список, если в архиве нет xl/workbook.xml или листы не найдены.
+    """
+    try:
+        with zipfile.ZipFile(BytesIO(file_bytes)) as z:
+            with z.open("xl/workbook.xml") as f:
+                root = ET.parse(f).getroot()
+            rel_types = {}
+            if "xl/_rels/workbook.xml.rels" in z.namelist():
+                with z.open("xl/_rels/workbook.xml.rels") as f:
+                    rel_types = {
+                        el.attrib.get("Id"): el.attrib.get("Type", "")
+                        for el in ET.parse(f).getroot().iterfind("{*}Relationship")
+                    }
+    except KeyError:
+        return []
+
+    names = []
+    # iter() не понимает {*}; wildcard по namespace поддерживают только find/findall/iterfind
+    for el in root.iterfind(".//{*}sheet"):
+        # Атрибут r:id хранится с полным namespace: {...relationships}id
+        rel_id = next((v for k, v in el.attrib.items() if k.endswith("}id")), None)
+        if rel_types and not rel_types.get(rel_id, "").endswith("/worksheet"):
+            continue
+        names.append(el.attrib["name"])
+    return names